@@ -7,10 +7,11 @@ Mixin models for generic Model functions:
 
 import logging
 import os
-import threading
+from collections import deque
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
 
 import util
 import reqfilter
@@ -20,6 +21,16 @@ import timescore
 DEBUG = settings.DEBUG
 DEBUG = False
 
+# Prefix for Cacheable models stored in memcache - change if the encoding changes so
+# that entries written by older versions are ignored.
+CACHE_FORMAT = 'pb2~'
+
+# Maximum number of entities the datastore accepts in a single batch put
+PUT_BATCH_MAX = 500
+
+# Number of models held in the request-local cache before evicting (clean) models
+CACHE_SIZE_MAX = 1000
+
 class Moderatable(db.Model):
     """
     A (mix-in) model which has content which can be reported and moderated.  This adds a single
@@ -105,31 +116,57 @@ class Migratable(db.Model):
         return model
 
     def update_schema(self):
+        if self._migrate_in_memory():
+            self.put()
+        
+    def _migrate_in_memory(self):
+        """
+        Migrate the model to the current schema (without writing it to storage).
+        
+        Returns True if the schema was changed.
+        """
         schema_old = self.schema
         if schema_old == self.schema_current:
-            return
+            return False
         
-        while db.schema < self.schema_current:
+        while self.schema < self.schema_current:
             self.migrate(self.schema+1)
             self.schema += 1
             
-        self.put()
         logging.info("Updating %s[%s] schema (%d -> %d)" % (
                 self.kind(),
                 self.key().id_or_name(),
                 schema_old,
                 self.schema))
+        return True
         
     @classmethod
     def update_schema_batch(cls, n=100):
         """
-        Migrate models in batch.
+        Migrate models in batch - written to storage with a single db.put.
         
         TODO: Deferred migration support via callback.
         """
         models = cls.all().filter('schema <', cls.schema_current).fetch(n)
-        for model in models:
-            model.update_schema()
+        models_changed = [model for model in models if model._migrate_in_memory()]
+        if models_changed:
+            try:
+                db.put(models_changed)
+            except db.BadValueError, e:
+                # Write the models individually so one bad model does not fail the batch
+                logging.info("Batch schema update failed (%s) - writing individually" % e.message)
+                for model in models_changed:
+                    try:
+                        model.put()
+                    except db.BadValueError, e:
+                        logging.info("Failed to update %s[%s] schema (%s)" % (
+                                model.kind(),
+                                model.key().id_or_name(),
+                                e.message))
+            else:
+                # db.put bypasses Cacheable.put - replace any old-schema cached copies
+                Cacheable._write_multi_to_cache([model for model in models_changed
+                                                 if isinstance(model, Cacheable)])
         return len(models)
 
     def migrate(self, schemaNext):
@@ -158,12 +195,14 @@ class Cacheable(db.Model):
             
         get_by_key_name(key_name, parent)
             retreives model from cache if possible
-        put()
-            write-through cache and put to store
+        put(sync_cache=True)
+            put to store and memcache (write-through) - if not sync_cache, the memcache
+            write is deferred to the end of the request
         get_or_insert(key_name, **kwds)
 
     these are additional methods:
     
+        get_by_key_names(key_names, parent) - batched get_by_key_name (returns a list)
         set_dirty() - marks model as dirty or critical - the later forces
             a write to store on exit, the later throttles to one write per second
             for this model
@@ -196,30 +235,82 @@ class Cacheable(db.Model):
         self._secs_put_last = 0
         self._write_rate = timescore.RateLimit(30)   # Peak writes to store - once each 2 seconds
         super(Cacheable, self).__init__(*args, **kwargs)
+        
+    # Request-specific cache state is not pickled - it is re-initialized on unpickle
+    _state_transient = ('_cache_state', '_is_memcached', '_secs_put_last', '_write_rate')
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self._state_transient:
+            state.pop(name, None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache_state = self.cache_state.clean
+        self._is_memcached = False
+        self._secs_put_last = 0
+        self._write_rate = timescore.RateLimit(30)
     
     @classmethod
-    def get_by_key_name(cls, key_name, parent=None):
+    def get_by_key_name(cls, key_names, parent=None):
         """
         override the Model.get_by_key_name method, to look in local or memcache
         storage first.
         
-        All key_name(s) must be strings.
-        
-        TODO: Support list of key_names - will need to call super are partial list of those
-        keys that are not yet cached!
+        All key_name(s) must be strings.  If a list of key_names is given, a list
+        of models (or None) is returned - see get_by_key_names.
         """
-        model = cls._model_from_cache(key_name)
-        if model is not None:
-            return model
+        if isinstance(key_names, (list, tuple)):
+            return cls.get_by_key_names(key_names, parent)
+        return cls.get_by_key_names([key_names], parent)[0]
+    
+    @classmethod
+    def get_by_key_names(cls, key_names, parent=None):
+        """
+        Return a list of models (or None) in the same order as key_names.
         
+        Models in request-local storage are used directly; the remainder are read
+        from memcache in a single get_multi, and any still missing are read from
+        storage in a single db.get.
+        """
+        local_store = cls._local_store()
+        models = {}
+        misses = []
+        for key_name in key_names:
+            sKey = cls._cache_key(key_name)
+            if sKey in local_store:
+                models[key_name] = local_store[sKey]
+            else:
+                misses.append(key_name)
+                
+        # Check memcache for the remainder - and update local store
+        if misses:
+            sKeys = [cls._cache_key(key_name) for key_name in misses]
+            mCached = memcache.get_multi(sKeys)
+            key_names_store = []
+            for key_name, sKey in zip(misses, sKeys):
+                model = cls._from_memcache(sKey, mCached.get(sKey))
+                if model is None:
+                    key_names_store.append(key_name)
+                    continue
+                models[key_name] = model
+            misses = key_names_store
+            
         # Go to storage
-        model = super(Cacheable, cls).get_by_key_name(key_name, parent)
-        if model is not None:
+        if misses:
+            if isinstance(parent, db.Model):
+                parent = parent.key()
+            keys = [db.Key.from_path(cls.kind(), key_name, parent=parent) for key_name in misses]
+            models_store = [model for model in db.get(keys) if model is not None]
             if DEBUG:
-                logging.info("Reading from storage: %s" % cls._cache_key(key_name))
-            model.ensure_cached()
+                for model in models_store:
+                    logging.info("Reading from storage: %s" % model._model_cache_key())
+            cls._write_multi_to_cache(models_store)
+            for model in models_store:
+                models[model.key().name()] = model
 
-        return model
+        return [models.get(key_name) for key_name in key_names]
     
     @classmethod
     def get_or_insert(cls, key_name, **kwargs):
@@ -235,24 +326,53 @@ class Cacheable(db.Model):
             
         return model
     
-    def put(self):
+    def put(self, sync_cache=True):
+        """
+        Write the model to storage and memcache.
+        
+        If sync_cache is False, the memcache copy is only updated at the end of the request
+        (see write_deferred_cache) - other requests read the old copy until then.  Only use
+        this in handlers run through CacheFilter.
+        """
         key = super(Cacheable, self).put()
         
         if DEBUG:
             logging.info("Writing to storage: %s" % self._model_cache_key())
         
         self._cache_state = self.cache_state.clean
-        self.ensure_cached()
+        if sync_cache:
+            # The memcache copy (if any) is now out of date
+            self._is_memcached = False
+            self.ensure_cached()
+        else:
+            self._set_local()
         return key
     
+    def _set_local(self):
+        """
+        Put this instance in the request-local store only - the memcache copy is written
+        by write_deferred_cache at the end of the request.
+        
+        Like ensure_cached, refuses to replace a different, modified instance.
+        """
+        sKey = self._model_cache_key()
+        local_store = self._local_store()
+        model = local_store.get(sKey)
+        if model is not None and model is not self and model._cache_state != self.cache_state.clean:
+            raise reqfilter.Error("Replacing modified model from cache: %s" % sKey)
+        
+        self._is_memcached = False
+        local_store[sKey] = self
+        
     def set_dirty(self, state=cache_state.dirty):
         """
         Mark the model as having changes to write to the store before the request is over.
+        
+        The memcache copy is written once, by write_deferred_cache, rather than on every call.
         """
-        self._is_memcached = False
         if state > self._cache_state:
             self._cache_state = state
-        self.ensure_cached()
+        self._set_local()
         
     def deferred_put(self):
         """
@@ -264,9 +384,7 @@ class Cacheable(db.Model):
         self.ensure_cached()
         
         try:
-            # Write to storage if critical or dirty AND old
-            if self._cache_state == self.cache_state.critical or \
-                not self._write_rate.is_exceeded(reqfilter.get_request().secsNow):
+            if self._is_put_ready():
                 self.put()
         except Exception, e:
             logging.info("Failed to write deferred-write cache: %s (%s)" % (
@@ -275,6 +393,17 @@ class Cacheable(db.Model):
                          ))
             pass
 
+    def _is_put_ready(self):
+        """
+        Return True if a dirty model should be written to storage now.
+        """
+        if self._cache_state == self.cache_state.clean:
+            return False
+        
+        # Write to storage if critical or dirty AND old
+        return self._cache_state == self.cache_state.critical or \
+            not self._write_rate.is_exceeded(reqfilter.get_request().secsNow)
+
     def ensure_cached(self):
         """
         ensures that this instance is in the cache.  If not, it will
@@ -310,18 +439,29 @@ class Cacheable(db.Model):
             return local_store[sKey]
         
         # Check if in memcache - and update local store
-        model = memcache.get(sKey)
-        if model is not None:
-            if DEBUG:
-                logging.info("Reading from global cache: %s" % sKey)
-            local_store[sKey] = model
-            
-            # Don't copy the cache_state from another instance/request
-            model._cache_state = cls.cache_state.clean
-            model._in_memcache = True
-            return model
+        return cls._from_memcache(sKey, memcache.get(sKey))
+    
+    @classmethod
+    def _from_memcache(cls, sKey, data):
+        """
+        Decode a model read from memcache and adopt it into the request-local store.
+        
+        Returns None if data is missing or not in the current CACHE_FORMAT.
+        """
+        model, rate_state = Cacheable._decode_cache(data)
+        if model is None:
+            return None
+        
+        if DEBUG:
+            logging.info("Reading from global cache: %s" % sKey)
+        cls._local_store()[sKey] = model
         
-        return None
+        # Don't copy the cache_state from another instance/request - but keep the write
+        # limiter so writes are throttled across requests
+        model._cache_state = cls.cache_state.clean
+        model._is_memcached = True
+        model._write_rate.value, model._write_rate.secs_last = rate_state
+        return model
   
     @staticmethod
     def _write_to_cache(model):
@@ -334,36 +474,238 @@ class Cacheable(db.Model):
             logging.info("Writing to cache: %s" % sKey)
         
         model._local_store()[sKey] = model
-        memcache.set(sKey, model)
+        memcache.set(sKey, Cacheable._encode_cache(model))
         
         model._is_memcached = True
         
+    @staticmethod
+    def _write_multi_to_cache(models):
+        """
+        unconditionally write the models to the local and memcache stores - using
+        a single memcache RPC.
+        """
+        if not models:
+            return
+        
+        local_store = Cacheable._local_store()
+        mModels = {}
+        for model in models:
+            sKey = model._model_cache_key()
+            if DEBUG:
+                logging.info("Writing to cache: %s" % sKey)
+            local_store[sKey] = model
+            mModels[sKey] = Cacheable._encode_cache(model)
+            
+        memcache.set_multi(mModels)
+        
+        for model in models:
+            model._is_memcached = True
+        
+    @staticmethod
+    def _encode_cache(model):
+        """
+        Models are stored in memcache as encoded entity protocol buffers - much smaller
+        (and faster to decode) than a pickled Model instance.  The write limiter state
+        (value, secs_last) is stored ahead of the protocol buffer; other non-persisted
+        attributes are re-initialized by the constructor when decoded.
+        """
+        rate = model._write_rate
+        return "%s%r~%d~%s" % (CACHE_FORMAT, rate.value, rate.secs_last,
+                               db.model_to_protobuf(model).Encode())
+    
+    @staticmethod
+    def _decode_cache(data):
+        """
+        Return (model, (value, secs_last)) - or (None, None) if data is missing or not in
+        the current CACHE_FORMAT.
+        """
+        if not isinstance(data, str) or not data.startswith(CACHE_FORMAT):
+            return None, None
+        sValue, sSecs, pb = data[len(CACHE_FORMAT):].split('~', 2)
+        model = db.model_from_protobuf(entity_pb.EntityProto(pb))
+        return model, (float(sValue), int(sSecs))
+        
     def _model_cache_key(self):
         return self._cache_key(self.key().name())
 
     @classmethod            
     def _cache_key(cls, key_name):
+        # Class prefix and version suffix are computed once per class (the app version is
+        # constant for the life of the instance).
+        affixes = cls.__dict__.get('_cache_key_affixes')
+        if affixes is None:
+            affixes = cls._cache_key_prefix()
+        return affixes[0] + key_name + affixes[1]
+    
+    @classmethod
+    def _cache_key_prefix(cls):
         # BUG: cls.__name__ probably not correct for PolyModel classes! 
-        return "%s~%s~Cache~%s" % (
-               cls.__name__,
-               key_name,
-               os.environ['CURRENT_VERSION_ID'])
+        cls._cache_key_affixes = ("%s~" % cls.__name__,
+                                  "~Cache~%s" % os.environ['CURRENT_VERSION_ID'])
+        return cls._cache_key_affixes
     
     @staticmethod    
     def _local_store():
-        return local.cache_storage
+        return _request_cache
 
 class CacheFilter(object):
     def process_response(self, req, resp):
-        write_deferred_cache()
+        try:
+            write_deferred_cache()
+        finally:
+            _request_cache.clear()
         return resp
         
 def write_deferred_cache():
-    for key,model in local.cache_storage.items():
-        model.deferred_put()
+    """
+    Write out all the dirty models in the request-local cache - using batched
+    db.put's (up to PUT_BATCH_MAX models each) and a single memcache.set_multi.
+    
+    Dirty models that are throttled by their write rate, and models put() during the
+    request, are only written to memcache.  Models of classes that override put() are
+    written individually with model.put().
+    """
+    models_put = []
+    models_cache = []
+    for model in _request_cache.values():
+        if model._cache_state == Cacheable.cache_state.clean:
+            if not model._is_memcached:
+                models_cache.append(model)
+            continue
+        
+        try:
+            fPut = model._is_put_ready()
+        except Exception, e:
+            logging.info("Failed to check deferred-write cache: %s (%s)" % (
+                         model._model_cache_key(),
+                         e.message
+                         ))
+            fPut = False
+            
+        if not fPut:
+            if not model._is_memcached:
+                models_cache.append(model)
+        elif type(model).put.im_func is not Cacheable.put.im_func:
+            try:
+                model.put()
+            except Exception, e:
+                logging.info("Failed to write deferred-write cache: %s (%s)" % (
+                             model._model_cache_key(),
+                             e.message
+                             ))
+            if not model._is_memcached:
+                models_cache.append(model)
+        else:
+            models_put.append(model)
             
-local = threading.local()
-local.cache_storage = {}
+    for models_batch in util.igroup_by(models_put, PUT_BATCH_MAX):
+        try:
+            db.put(models_batch)
+            models_written = models_batch
+        except Exception, e:
+            # Write the models individually so one bad model does not fail the batch
+            logging.info("Failed to write deferred-write cache batch: %d models (%s)" % (
+                         len(models_batch),
+                         e.message
+                         ))
+            models_written = []
+            for model in models_batch:
+                try:
+                    db.put(model)
+                    models_written.append(model)
+                except Exception, e:
+                    logging.info("Failed to write deferred-write cache: %s (%s)" % (
+                                 model._model_cache_key(),
+                                 e.message
+                                 ))
+                    if not model._is_memcached:
+                        models_cache.append(model)
+                        
+        for model in models_written:
+            model._cache_state = Cacheable.cache_state.clean
+        models_cache.extend(models_written)
+    
+    try:
+        Cacheable._write_multi_to_cache(models_cache)
+    except Exception, e:
+        logging.info("Failed to write deferred-write memcache: %d models (%s)" % (
+                     len(models_cache),
+                     e.message
+                     ))
+            
+class RequestCache(dict):
+    """
+    Request-local model cache - a dict which evicts models when it holds more than size_max.
+    
+    When full, the least recently stored models are evicted (down to 3/4 of size_max).  Reads
+    are plain dict lookups, so are not tracked.  Only clean models that are already in
+    memcache are evicted, so eviction never writes to storage or memcache (dirty models are
+    written by write_deferred_cache).
+    """
+    def __init__(self, size_max=CACHE_SIZE_MAX):
+        dict.__init__(self)
+        self.size_max = size_max
+        self._size_evict = size_max
+        self._tick = 0
+        # key -> tick of the last store, and (tick, key) in store order - entries whose
+        # tick is out of date are skipped when evicting
+        self._ticks = {}
+        self._order = deque()
+        
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        # Repeated stores of the most recent key (e.g., set_dirty in a loop) need no new entry
+        if self._ticks.get(key) != self._tick:
+            self._tick += 1
+            self._ticks[key] = self._tick
+            self._order.append((self._tick, key))
+        if len(self) > self._size_evict:
+            self._evict()
+            
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        del self._ticks[key]
+        
+    def pop(self, key, *args):
+        self._ticks.pop(key, None)
+        return dict.pop(self, key, *args)
+    
+    def clear(self):
+        dict.clear(self)
+        self._ticks.clear()
+        self._order.clear()
+        self._size_evict = self.size_max
+        
+    def _evict(self):
+        count = len(self) - self.size_max*3//4
+        order = self._order
+        ticks = self._ticks
+        kept = []
+        while count > 0 and order:
+            tick, key = order.popleft()
+            if ticks.get(key) != tick:
+                continue
+            if self._is_evictable(dict.__getitem__(self, key)):
+                self.pop(key)
+                count -= 1
+            else:
+                kept.append((tick, key))
+        # Models that cannot be evicted keep their place in the order
+        order.extendleft(reversed(kept))
+        if DEBUG:
+            logging.info("Evicted models from request cache: %d remain" % len(self))
+            
+        # If too many models are dirty to evict, let the cache grow before trying again
+        self._size_evict = max(self.size_max, len(self) + self.size_max//4)
+        
+    @staticmethod
+    def _is_evictable(model):
+        return model._cache_state == Cacheable.cache_state.clean and model._is_memcached
+        
+# Request-local model cache (cleared by CacheFilter at the end of each request).
+# App Engine runs one request at a time per instance, so a plain dict is used rather
+# than a threading.local.
+_request_cache = RequestCache()
 
 def unique_models(models):
     """
@@ -372,19 +714,31 @@ def unique_models(models):
     Assumes all models are of the same type.
     """
     keys = set()
+    keys_add = keys.add
     unique_models = []
+    unique_append = unique_models.append
     
     for model in models:
         key = model.key().id_or_name()
         if key in keys:
             continue
-        keys.add(key)
-        unique_models.append(model)
+        keys_add(key)
+        unique_append(model)
         
     return unique_models
 
 def exclude_models(models, models_exclude):
-    keys_exclude = set((model.key().id_or_name() for model in models_exclude))
+    keys_exclude = frozenset([model.key().id_or_name() for model in models_exclude])
     results = [model for model in models if model.key().id_or_name() not in keys_exclude]
     return results
+
+def iter_exclude_models(models, models_exclude):
+    """
+    Generate the models whose keys are not in models_exclude (for callers that
+    only iterate the results once).
+    """
+    keys_exclude = frozenset([model.key().id_or_name() for model in models_exclude])
+    for model in models:
+        if model.key().id_or_name() not in keys_exclude:
+            yield model
         
\ No newline at end of file
@@ -0,0 +1,199 @@
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import mixins
+import reqfilter
+
+import unittest
+
+class CacheModel(mixins.Cacheable):
+    count = db.IntegerProperty(default=0)
+    
+class PutModel(CacheModel):
+    puts = 0
+    
+    def put(self, sync_cache=True):
+        PutModel.puts += 1
+        return super(PutModel, self).put(sync_cache)
+    
+class MigrateModel(mixins.Migratable, mixins.Cacheable):
+    schema_current = 2
+    count = db.IntegerProperty(default=0)
+    
+    def migrate(self, schemaNext):
+        self.count += 10
+        
+class Request(object):
+    secsNow = 1000
+    
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        
+        self.req = Request()
+        self.get_request = reqfilter.get_request
+        reqfilter.get_request = lambda: self.req
+        mixins._request_cache.clear()
+        
+    def tearDown(self):
+        mixins._request_cache.clear()
+        reqfilter.get_request = self.get_request
+        self.testbed.deactivate()
+        
+    def end_request(self):
+        mixins.CacheFilter().process_response(self.req, None)
+        
+class TestCacheable(CacheTest):
+    def test_put(self):
+        model = CacheModel(key_name='a', count=1)
+        model.put()
+        
+        # Written through to memcache - without CacheFilter running at the end of the request
+        mixins._request_cache.clear()
+        model = CacheModel.get_by_key_name('a')
+        self.assert_(model._is_memcached)
+        model.count = 2
+        model.put()
+        mixins._request_cache.clear()
+        self.assertEqual(CacheModel.get_by_key_name('a').count, 2)
+        
+    def test_write_rate(self):
+        model = CacheModel(key_name='a', count=1)
+        model.put()
+        
+        # A burst of writes fills the write limiter - the change is only cached
+        model._write_rate.current_value(self.req.secsNow, model._write_rate.threshold)
+        model.count = 2
+        model.set_dirty()
+        self.end_request()
+        self.assertEqual(db.get(model.key()).count, 1)
+        
+        # The limiter is read back from memcache, so the next request is throttled too
+        model = CacheModel.get_by_key_name('a')
+        self.assertEqual(model.count, 2)
+        model.count = 3
+        model.set_dirty()
+        self.failIf(model._is_put_ready())
+        self.end_request()
+        self.assertEqual(db.get(model.key()).count, 1)
+        self.assertEqual(CacheModel.get_by_key_name('a').count, 3)
+        
+    def test_get_by_key_names(self):
+        CacheModel(key_name='a', count=1).put()
+        mixins._request_cache.clear()
+        # Only in storage
+        db.put(CacheModel(key_name='b', count=2))
+        model = CacheModel(key_name='c', count=3)
+        model.set_dirty()
+        
+        models = CacheModel.get_by_key_names(['b', 'x', 'c', 'a'])
+        self.assertEqual([m and m.count for m in models], [2, None, 3, 1])
+        self.assert_(models[2] is model)
+        self.assert_(models[0]._is_memcached)
+        self.assert_(CacheModel.get_by_key_name('b') is models[0])
+        
+class TestDeferredCache(CacheTest):
+    def test_batch(self):
+        models = [CacheModel(key_name='k%d' % i, count=i) for i in range(mixins.PUT_BATCH_MAX + 10)]
+        for model in models:
+            model.set_dirty(CacheModel.cache_state.critical)
+        self.end_request()
+        
+        self.assertEqual([m.count for m in db.get([m.key() for m in models])], range(len(models)))
+        for model in models:
+            self.assertEqual(model._cache_state, CacheModel.cache_state.clean)
+            self.assert_(model._is_memcached)
+            
+    def test_put_override(self):
+        PutModel.puts = 0
+        model = PutModel(key_name='a', count=1)
+        model.set_dirty(CacheModel.cache_state.critical)
+        self.end_request()
+        self.assertEqual(PutModel.puts, 1)
+        self.assertEqual(db.get(model.key()).count, 1)
+        
+    def test_put_ready_error(self):
+        model = CacheModel(key_name='a', count=1)
+        model.set_dirty()
+        
+        def get_request():
+            raise AttributeError("No request")
+        reqfilter.get_request = get_request
+        self.end_request()
+        self.assertEqual(len(mixins._request_cache), 0)
+        self.assertEqual(db.get(model.key()), None)
+        
+        # Still written to memcache
+        reqfilter.get_request = lambda: self.req
+        self.assertEqual(CacheModel.get_by_key_name('a').count, 1)
+        
+class TestMigratable(CacheTest):
+    def test_update_schema_batch(self):
+        MigrateModel(key_name='a', count=1).put()
+        mixins._request_cache.clear()
+        
+        self.assertEqual(MigrateModel.update_schema_batch(), 1)
+        self.assertEqual(db.get(db.Key.from_path('MigrateModel', 'a')).count, 11)
+        
+        # The cached copy is updated too
+        mixins._request_cache.clear()
+        model = MigrateModel._model_from_cache('a')
+        self.assertEqual((model.schema, model.count), (2, 11))
+        
+class Entry(object):
+    def __init__(self, cache_state=CacheModel.cache_state.clean, is_memcached=True):
+        self._cache_state = cache_state
+        self._is_memcached = is_memcached
+        
+class TestRequestCache(unittest.TestCase):
+    def test_order(self):
+        cache = mixins.RequestCache(8)
+        for i in range(8):
+            cache['k%d' % i] = Entry()
+        # Storing again makes k0 the most recent
+        cache['k0'] = Entry()
+        self.assertEqual(len(cache), 8)
+        
+        cache['k8'] = Entry()
+        self.assertEqual(sorted(cache.keys()), ['k0', 'k4', 'k5', 'k6', 'k7', 'k8'])
+        
+        # Reads do not change the order
+        cache['k4']
+        cache.get('k5')
+        for i in range(9, 12):
+            cache['k%d' % i] = Entry()
+        self.assertEqual(sorted(cache.keys()), ['k0', 'k10', 'k11', 'k7', 'k8', 'k9'])
+        
+    def test_dirty(self):
+        cache = mixins.RequestCache(8)
+        for i in range(3):
+            cache['dirty%d' % i] = Entry(CacheModel.cache_state.dirty, False)
+        cache['critical'] = Entry(CacheModel.cache_state.critical, True)
+        for i in range(2):
+            cache['local%d' % i] = Entry(is_memcached=False)
+        for i in range(3):
+            cache['k%d' % i] = Entry()
+        self.assertEqual(sorted(cache.keys()), ['critical', 'dirty0', 'dirty1', 'dirty2', 'local0', 'local1'])
+        
+    def test_size_evict(self):
+        cache = mixins.RequestCache(8)
+        for i in range(9):
+            cache['k%d' % i] = Entry(CacheModel.cache_state.dirty, False)
+        # Nothing can be evicted - wait until the cache grows another quarter
+        self.assertEqual(len(cache), 9)
+        self.assertEqual(cache._size_evict, 11)
+        cache['a'] = Entry()
+        cache['b'] = Entry()
+        self.assertEqual(len(cache), 11)
+        cache['c'] = Entry()
+        self.assertEqual(sorted(cache.keys()), ['k%d' % i for i in range(9)])
+        self.assertEqual(cache._size_evict, 11)
+        
+        cache.clear()
+        self.assertEqual(cache._size_evict, 8)
+        
+if __name__ == '__main__':
+    unittest.main()
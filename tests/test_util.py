@@ -0,0 +1,94 @@
+import util
+import reqfilter
+
+import unittest
+
+class TestMemoize(unittest.TestCase):
+    def test_types(self):
+        calls = []
+        @util.memoize()
+        def f(x):
+            calls.append(x)
+            return repr(x)
+        self.assertEqual(f(1), '1')
+        self.assertEqual(f(1.0), '1.0')
+        self.assertEqual(f(1), '1')
+        self.assertEqual(calls, [1, 1.0])
+        
+    def test_error(self):
+        calls = []
+        @util.memoize()
+        def f(x):
+            calls.append(x)
+            raise reqfilter.Error("bad: %s" % x)
+        self.assertRaises(reqfilter.Error, f, 'a')
+        self.assertRaises(reqfilter.Error, f, 'a')
+        self.assertEqual(len(calls), 2)
+        
+    def test_size_max(self):
+        calls = []
+        @util.memoize(3)
+        def f(x):
+            calls.append(x)
+            return x
+        for x in [1, 2, 3, 1, 2, 3]:
+            f(x)
+        self.assertEqual(calls, [1, 2, 3])
+        # Cache is full - emptied before 4 is added
+        f(4)
+        f(1)
+        self.assertEqual(calls, [1, 2, 3, 4, 1])
+        
+    def test_unhashable(self):
+        calls = []
+        @util.memoize()
+        def f(x):
+            calls.append(x)
+            return len(x)
+        self.assertEqual(f([1, 2]), 2)
+        self.assertEqual(f([1, 2]), 2)
+        self.assertEqual(len(calls), 2)
+        
+    def test_kwargs(self):
+        @util.memoize()
+        def f(x, y=0):
+            return x + y
+        self.assertEqual(f(1, y=2), 3)
+        self.assertEqual(f(1, y=3), 4)
+        self.assertEqual(f(1), 1)
+
+class TestNormalizeUrl(unittest.TestCase):
+    def test_scheme(self):
+        self.assertEqual(util.normalize_url('example.com'), 'http://example.com/')
+        self.assertEqual(util.normalize_url('  https://Example.COM/a?b=1#c '), 'https://example.com/a?b=1#c')
+        self.assertRaises(reqfilter.Error, util.normalize_url, 'ftp://example.com/')
+        self.assertRaises(reqfilter.Error, util.normalize_url, 'mailto:a@b.com')
+        self.assertEqual(util.normalize_url('a.co/://x'), 'http://a.co/://x')
+        
+    def test_domain(self):
+        self.assertEqual(util.normalize_url('http://192.168.1.1'), 'http://192.168.1.1/')
+        self.assertEqual(util.normalize_url('www.site.co.uk/path'), 'http://www.site.co.uk/path')
+        self.assertEqual(util.normalize_url('a.com/x', 'Canon.com'), 'http://canon.com/x')
+        for url in ['foo', 'http://-bad.com/', 'http://a.xyz/', 'http://x.com./', 'http://']:
+            self.assertRaises(reqfilter.Error, util.normalize_url, url)
+        
+    def test_port_and_user(self):
+        self.assertEqual(util.normalize_url('http://x.com:8080/'), 'http://x.com:8080/')
+        self.assertEqual(util.normalize_url('x.com:80/a'), 'http://x.com:80/a')
+        self.assertEqual(util.normalize_url('http://user@x.com/'), 'http://user@x.com/')
+        self.assertEqual(util.normalize_url('http://user:pw@x.com:8080/a'), 'http://user:pw@x.com:8080/a')
+        self.assertRaises(reqfilter.Error, util.normalize_url, 'http://user@bad:8080/')
+        self.assertRaises(reqfilter.Error, util.normalize_url, 'http://x.com@:8080/')
+        
+    def test_localhost(self):
+        # The dev server address is only allowed when DEBUG
+        if util.DEBUG:
+            self.assertEqual(util.normalize_url('localhost:8080/a'), 'http://localhost:8080/a')
+        else:
+            self.assertRaises(reqfilter.Error, util.normalize_url, 'localhost:8080/a')
+            
+    def test_domain_from_url(self):
+        self.assertEqual(util.domain_from_url('http://x.com:8080/a'), 'x.com:8080')
+
+if __name__ == '__main__':
+    unittest.main()
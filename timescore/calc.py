@@ -2,7 +2,11 @@ from datetime import datetime
 import math
 import logging
 
-class Score():
+# log2(x) == math.log(x) * inv_ln2 (math.log2 is not available in python 2)
+ln2 = math.log(2)
+inv_ln2 = 1.0/ln2
+
+class Score(object):
     """
     Base functions for calculating half-life values from a stream of scoring events.
     
@@ -18,11 +22,28 @@ class Score():
         are based at value = 1 at time = 0.  Negative log scores would occur for score values less
         than 1 at time = 0 - these are not allowed.
         """
+        self._init_fields(time_half, log_score, time_last)
+        self.increment(0, self.time_last)
+        
+    @classmethod
+    def from_log(cls, time_half, log_score, time_last):
+        """
+        Construct a Score without normalizing it to time_last - use when increment() will
+        be called immediately.  self.score is None until then.
+        """
+        ts = cls.__new__(cls)
+        ts._init_fields(time_half, log_score, time_last)
+        ts.score = None
+        return ts
+        
+    def _init_fields(self, time_half, log_score, time_last):
         self.time_half = float(time_half)
-        self.k = 0.5 ** (1.0/self.time_half)
+        self._inv_half = 1.0/self.time_half
+        self.k = 0.5 ** self._inv_half
+        # k ** dt == math.exp(self._decay_coef * dt)
+        self._decay_coef = -ln2 * self._inv_half
         self.time_last = float(time_last)
         self.log_score = float(log_score)
-        self.increment(0, self.time_last)
         
     def increment(self, value=0.0, time_now=None):
         """
@@ -31,23 +52,25 @@ class Score():
         
         Note that self.score is an output variable only (calculated from log_score).
         """
-        value = float(value)
+        # Callers usually pass floats already - only convert when needed
+        if type(value) is not float:
+            value = float(value)
         
         if time_now is None:
             time_now = self.time_last
-        else:
+        elif type(time_now) is not float:
             time_now = float(time_now)
         
         if time_now > self.time_last:
-            self.score = 2.0 ** (self.log_score - time_now/self.time_half)
+            self.score = 2.0 ** (self.log_score - time_now*self._inv_half)
             self.score += value
             self.time_last = time_now
         else:
-            self.score = 2.0 ** (self.log_score - self.time_last/self.time_half)
-            self.score += (self.k ** (self.time_last - time_now)) * value
+            self.score = 2.0 ** (self.log_score - self.time_last*self._inv_half)
+            self.score += math.exp(self._decay_coef * (self.time_last - time_now)) * value
 
         try:    
-            self.log_score = math.log(self.score)/math.log(2) + self.time_last/self.time_half
+            self.log_score = math.log(self.score)*inv_ln2 + self.time_last*self._inv_half
         except:
             # Even on underflow, we want to advance the time_last to the present.
             # The score for an underflow value will be zero, we also set the log to zero
@@ -61,6 +84,48 @@ class Score():
             """
             self.score = 0.0
             self.log_score = 0.0
+
+def batch_increment(log_scores, time_last, half_lives, value=0.0, time_now=None):
+    """
+    Increment a set of log scores (one per half-life) which share a common time_last.
+    
+    Equivalent to calling Score(half_life, log_score, time_last).increment(value, time_now)
+    for each half-life, without constructing the intermediate Score objects.
+    
+    Returns (log_scores, time_last) - the new list of log scores and their common time_last.
+    
+    Note: this (and Score) must remain pure python - App Engine does not load C extension
+    modules (Cython/Numba), so bulk rescoring should go through this function.
+    """
+    if type(value) is not float:
+        value = float(value)
+    if type(time_last) is not float:
+        time_last = float(time_last)
+    if time_now is None:
+        time_now = time_last
+    elif type(time_now) is not float:
+        time_now = float(time_now)
+        
+    fAdvance = time_now > time_last
+    if fAdvance:
+        time_last = time_now
+    dt = time_last - time_now
+    
+    results = []
+    for log_score, time_half in zip(log_scores, half_lives):
+        inv_half = 1.0/time_half
+        score = 2.0 ** (log_score - time_last*inv_half)
+        if fAdvance:
+            score += value
+        else:
+            score += math.exp(-ln2 * dt * inv_half) * value
+        if score > 0.0:
+            results.append(math.log(score)*inv_ln2 + time_last*inv_half)
+        else:
+            # Underflow - see Score.increment
+            results.append(0.0)
+            
+    return results, time_last
             
 class RateLimit(object):
     """
@@ -74,6 +139,8 @@ class RateLimit(object):
         self.value = 0.0
         self.threshold = threshold
         self.k = 0.5 ** (1.0/secs_half)
+        # k ** dt == math.exp(self._decay_coef * dt)
+        self._decay_coef = -ln2 / secs_half
         self.secs_last = 0
         
     def is_exceeded(self, secs, value=1.0):
@@ -103,8 +170,10 @@ class RateLimit(object):
         if secs < self.secs_last:
             return self.value
         
-        # Decay current value
-        self.value *= (self.k ** (secs - self.secs_last))
+        # Decay current value - nothing to decay within the same second or from zero (the
+        # common case for repeated checks during a single request)
+        if self.value and secs != self.secs_last:
+            self.value *= math.exp(self._decay_coef * (secs - self.secs_last))
         self.secs_last = secs
         self.value += value
         
@@ -46,6 +46,11 @@ def scorable(half_lives=None):
         TS_NAME_score = db.FloatProperty() - Log(S) for each half-life being scored
         TS_hrs = db.FloatProperty() - Number of hours since 1/1/2001 at last scoring
         TS_half_lives - non-persisted list of half lives computed for this model       
+        TS_names, TS_attr_names - names and property names for each of TS_half_lives
+        
+    Each half-life score is stored in its own FloatProperty (rather than packed into a
+    single ListProperty) since the datastore can only order queries by a whole property
+    (see order_by_score) - a list property sorts by its min or max element.
         
     Note, because app engine db.Model uses a metaclass, this could not
     be implemented as a class decorator, as it must be run during
@@ -63,10 +68,12 @@ def scorable(half_lives=None):
         """
         prop_dict = {}
         prop_dict['TS_half_lives'] = tuple(half_lives)
+        prop_dict['TS_names'] = tuple([halflife_name(hrs) for hrs in half_lives])
+        prop_dict['TS_attr_names'] = tuple([halflife_attr(hrs) for hrs in half_lives])
         
         # Add Model properties to the class    
-        for hrs in half_lives:
-            prop_dict['TS_%s_score' % halflife_name(hrs)] = db.FloatProperty(required=True, default=0.0)
+        for attr in prop_dict['TS_attr_names']:
+            prop_dict[attr] = db.FloatProperty(required=True, default=0.0)
             
         prop_dict['TS_hrs'] = db.FloatProperty(required=True, default=0.0)
         
@@ -92,11 +99,21 @@ def scorable(half_lives=None):
         """
         Update the model properties for the timescore values to bring up to the current
         time.  Increasing in score will (attempt to) write the datastore.
+        
+        update_scores is for writes only - use named_scores or score_now (read-only) to
+        display the current scores.
         """
-        for half_life in self.TS_half_lives:
-            ts = self.score_now(half_life, dt, value=value)
-            setattr(self, halflife_attr(half_life), ts.log_score)
-            self.TS_hrs = ts.time_last
+        # Advancing the (non-dirty) scores to the current time does not change their
+        # log values - nothing to do.
+        if value == 0 and dt is None and self.TS_hrs != 0.0:
+            return
+        
+        attr_names = self.TS_attr_names
+        log_scores, self.TS_hrs = calc.batch_increment(
+            [getattr(self, attr) for attr in attr_names],
+            self.TS_hrs, self.TS_half_lives, value, hours_from_datetime(dt))
+        for attr, log_score in zip(attr_names, log_scores):
+            setattr(self, attr, log_score)
         
         # If we've updated score - we want to persist the model (eventually)
         if value > 0:    
@@ -109,7 +126,7 @@ def scorable(half_lives=None):
         
         NOT written back to the data store
         """
-        ts = calc.Score(half_life, getattr(self, halflife_attr(half_life)), time_last=self.TS_hrs)
+        ts = calc.Score.from_log(half_life, getattr(self, halflife_attr(half_life)), self.TS_hrs)
         ts.increment(value, hours_from_datetime(dt))
         return ts
     
@@ -119,8 +136,11 @@ def scorable(half_lives=None):
         that dt is >= any past scoring time for this model.
         """
         mScores = {}
-        for half_life in self.TS_half_lives:
-            mScores[halflife_name(half_life)] = self.score_now(half_life, dt).score
+        hrs = hours_from_datetime(dt)
+        for half_life, name, attr in zip(self.TS_half_lives, self.TS_names, self.TS_attr_names):
+            ts = calc.Score.from_log(half_life, getattr(self, attr), self.TS_hrs)
+            ts.increment(0, hrs)
+            mScores[name] = ts.score
         return mScores
     
     def is_new_score(self):
@@ -154,19 +174,28 @@ def set_timescore_results(results, half_life, dt=None):
     return results
             
 def hours_from_datetime(dt=None):
+    """
+    Hours since dtBase - for the current request time if dt is None (computed once
+    per request and saved as req.hrsNow).
+    """
     if dt is None:
-        dt = reqfilter.get_request().dtNow
+        req = reqfilter.get_request()
+        hrs = getattr(req, 'hrsNow', None)
+        if hrs is None:
+            hrs = req.hrsNow = hours_from_datetime(req.dtNow)
+        return hrs
     ddt = dt - dtBase
-    hrs = ddt.days*hrsDay + float(ddt.seconds)/60/60
-    return hrs
+    return ddt.days*hrsDay + ddt.seconds/3600.0
 
 def datetime_from_hours(hrs):
     ddt = timedelta(float(hrs/hrsDay))
     dt = dtBase + ddt
     return dt
 
+halflife_names = {hrsDay:'day', hrsWeek:'week', hrsMonth:'month', hrsYear:'year'}
+
 def halflife_name(half_life):
-    return {hrsDay:'day', hrsWeek:'week', hrsMonth:'month', hrsYear:'year'}.get(half_life, str(half_life))
+    return halflife_names.get(half_life, str(half_life))
 
 def halflife_attr(half_life):
     return 'TS_%s_score' % halflife_name(half_life)
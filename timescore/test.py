@@ -46,6 +46,29 @@ class TestTimeScore(unittest.TestCase):
         sc.increment(0, 1)
         self.assertEqual(sc.log_score, sLog)
 
+    def test_from_log(self):
+        for log_score, time_last, value, t in [(0, 0, 1, 0), (3.5, 10, 2, 20), (3.5, 10, 1, 5)]:
+            sc = calc.Score(24, log_score, time_last)
+            sc.increment(value, t)
+            sc2 = calc.Score.from_log(24, log_score, time_last)
+            self.assertEqual(sc2.score, None)
+            sc2.increment(value, t)
+            self.assertAlmostEqual(sc.score, sc2.score, 10)
+            self.assertAlmostEqual(sc.log_score, sc2.log_score, 10)
+            self.assertEqual(sc.time_last, sc2.time_last)
+        
+    def test_batch(self):
+        half_lives = (1, 24, 24*7)
+        scores = [calc.Score(half) for half in half_lives]
+        log_scores = [sc.log_score for sc in scores]
+        time_last = 0.0
+        for value, t in [(1, 1), (2, 5), (1, 3), (0, 10), (5, 48), (1, 2000)]:
+            log_scores, time_last = calc.batch_increment(log_scores, time_last, half_lives, value, t)
+            for sc, log_score in zip(scores, log_scores):
+                sc.increment(value, t)
+                self.assertAlmostEqual(sc.log_score, log_score, 10)
+                self.assertEqual(sc.time_last, time_last)
+
 class TestRateLimit(unittest.TestCase):
     def test_base(self):
         rate = calc.RateLimit(0)
@@ -1,6 +1,9 @@
 import re
-import urlparse
+import string
+from urlparse import urlsplit, urlunsplit
 import logging
+from itertools import islice
+from functools import wraps
 
 from google.appengine.ext import db
 
@@ -9,42 +12,84 @@ import reqfilter
 
 DEBUG = settings.DEBUG
 
+def memoize(size_max=4096):
+    """
+    Function decorator to cache the results of a pure function of hashable arguments.
+    
+    Usage:
+    
+        @memoize(1000)
+        def my_function(s)
+            ...
+            
+    The cache is emptied when it reaches size_max entries.  Exceptions are not cached.
+    """
+    def _memoize(func):
+        cache = {}
+        
+        @wraps(func)
+        def _memoized(*args, **kwargs):
+            # Include the argument types - so that, e.g., 1 and 1.0 are cached separately
+            key = args + tuple([type(arg) for arg in args])
+            if kwargs:
+                key += tuple(sorted(kwargs.items()))
+            try:
+                return cache[key]
+            except KeyError:
+                pass
+            except TypeError:
+                # Unhashable arguments
+                return func(*args, **kwargs)
+            result = func(*args, **kwargs)
+            if len(cache) >= size_max:
+                cache.clear()
+            cache[key] = result
+            return result
+        return _memoized
+    return _memoize
+
 def href(url):
-    # Quote url text so it can be embedded in an HTML href
-    ich = url.find('//')
-    path = url[ich+2:].replace('"', '%22')
-    return url[0:ich+2] + path
+    # Quote url text so it can be embedded in an HTML href (the scheme and host
+    # cannot contain quotes, so the whole url can be replaced)
+    return url.replace('"', '%22')
+
+# str.translate tables to delete control characters (\000-\037)
+trans_identity = string.maketrans('', '')
+ctrl_chars = ''.join([chr(i) for i in range(32)])
 
 def trim_string(st):
-    if st == None:
-        st = ''
-    return re.sub('[\000-\037]', '', str(st)).strip()
+    if st is None:
+        return ''
+    if type(st) is not str:
+        st = str(st)
+    return st.translate(trans_identity, ctrl_chars).strip()
 
 def escape_html(s):
     # Escape test so it does not have embedded HTML sequences
+    # Note: cgi.escape does not escape single quotes (and html.escape is python 3 only).
+    # Chained str.replace calls are faster than a regex sub with a replacement function.
+    if '&' not in s and '<' not in s and '>' not in s and '"' not in s and "'" not in s:
+        return s
     return s.replace('&', '&amp;').\
         replace('<', '&lt;').\
         replace('>', '&gt;').\
         replace('"', '&quot;').\
         replace("'", '&#39;')
 
-regNonchar = re.compile(r"[^\w]")
-regDashes = re.compile(r"[\-]+")
-regPrePostDash = re.compile(r"(^-+)|(-+$)")
+regNonchars = re.compile(r"[^\w]+")
 
+@memoize()
 def slugify(s):
     """
     Convert runs of all non-alphanumeric characters to single dashes
     """
     if s is None:
-        s = ""
-    s = str(s)
-    s = regNonchar.sub('-', s).lower()
-    s = regDashes.sub('-', s)
-    s = regPrePostDash.sub('', s)
-    return s
+        return ""
+    if type(s) is not str:
+        s = str(s)
+    return regNonchars.sub('-', s).lower().strip('-')
 
-regBanned = re.compile(r"cunt|fuck|pussy|shit|tits")
+regBanned = re.compile(r"cunt|fuck|pussy|shit|tits", re.I)
 
 def has_bad_word(s):
     return regBanned.search(s) is not None
@@ -59,8 +104,11 @@ def run_in_transaction(func):
         def my_function()
             ...
     """
+    run = db.run_in_transaction
+    
+    @wraps(func)
     def _transaction(*args, **kwargs):
-        return db.run_in_transaction(func, *args, **kwargs)
+        return run(func, *args, **kwargs)
     return _transaction
 
 def group_by(aList, n):
@@ -69,6 +117,16 @@ def group_by(aList, n):
     
     return [aList[i:i+n] for i in range(0, len(aList), n)]
 
+def igroup_by(iterable, n):
+    """ Generate lists of n elements at a time from any iterable (the last may be shorter)
+    - for large or lazy sequences that need not be held in memory at once """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
 
 class enum(object):
     """
@@ -89,17 +147,18 @@ class enum(object):
         value = 0
         self.__names = args
         self.__dict = {}
+        self.__reverse = {}
         for name in args:
             if kw.has_key(name):
                 value = kw[name]
             self.__dict[name] = value
+            self.__reverse.setdefault(value, name)
             value = value + 1
+        # Values are plain instance attributes (no __getattr__ call on each access)
+        self.__dict__.update(self.__dict)
         self.__init = 0
 
     def __getitem__(self, name):
-        return getattr(self, name)
-
-    def __getattr__(self, name):
         return self.__dict[name]
 
     def __setattr__(self, name, value):
@@ -109,14 +168,13 @@ class enum(object):
             raise AttributeError, "enum is ReadOnly"
 
     def __call__(self, name_or_value):
-        if type(name_or_value) == type(0):
-            for name in self.__names:
-                if getattr(self, name) == name_or_value:
-                    return name
-            else:
+        if isinstance(name_or_value, int):
+            try:
+                return self.__reverse[name_or_value]
+            except KeyError:
                 raise TypeError, "no enum for %d" % name_or_value
         else:
-            return getattr(self, name_or_value)
+            return self.__dict[name_or_value]
 
     def __repr__(self):
         result = ['<enum']
@@ -146,16 +204,21 @@ url parsing and helper functions
 # Allow all the country domains (2 letter), and the currently defined gTLD's
 # Also allow raw IP addresses, e.g., 192.168.1.1
 # BUG - handle "Unicode domains"
-regDomain = re.compile(r"^" + \
-    r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})|" + \
-    r"(([a-z0-9][a-z0-9-]*\.)+([a-z]{2}|" + \
-        r"aero|asia|biz|cat|com|coop|edu|gov|info|int|jobs|mil|mobi|museum|net|org|pro|tel|travel))|" + \
-    r"(pageslike)|(localhost)" if DEBUG else "" +
-    "$", re.I)
+regDomain = re.compile(r"(?:" + \
+    r"\d{1,3}(?:\.\d{1,3}){3}|" + \
+    r"(?:[a-z0-9][a-z0-9-]*\.)+(?:[a-z]{2}|" + \
+        r"aero|asia|biz|cat|com|coop|edu|gov|info|int|jobs|mil|mobi|museum|net|org|pro|tel|travel)" + \
+    (r"|pageslike|localhost" if DEBUG else "") + \
+    r")\Z", re.I)
+match_domain = regDomain.match
+
+# A leading scheme - "host:port" (a digit after the colon) is not a scheme
+regScheme = re.compile(r"[a-z][a-z0-9+.-]*:(?!\d)", re.I)
 
 # ordering of urlparse.urlsplit() array elements
-split = enum('scheme', 'domain', 'path', 'query', 'fragment')
+SCHEME, DOMAIN, PATH, QUERY, FRAGMENT = range(5)
 
+@memoize()
 def normalize_url(url, domain_canonical=None):
     """
     Ensure we have a value url - raise exception if not.
@@ -163,30 +226,32 @@ def normalize_url(url, domain_canonical=None):
     If given, we convert the domain to a domain_canonical
     """
     url = url.strip()
-    rgURL = list(urlparse.urlsplit(url))
-    if rgURL[split.scheme] == '':
-        url = r"http://%s" % url
-        rgURL = list(urlparse.urlsplit(url))
+    # Default to http - checked before splitting so the url is only parsed once
+    if not regScheme.match(url):
+        url = "http://" + url
+    scheme, domain, path, query, fragment = urlsplit(url)
     
     # Invalid protocol
-    if rgURL[split.scheme] != "http" and rgURL[split.scheme] != "https":
-        raise reqfilter.Error("Invalid protocol: %s" % rgURL[split.scheme]) 
+    if scheme != "http" and scheme != "https":
+        raise reqfilter.Error("Invalid protocol: %s" % scheme) 
 
     if domain_canonical is not None:
-        rgURL[split.domain] = domain_canonical
+        domain = domain_canonical
     
-    if rgURL[split.domain]:
-        rgURL[split.domain] = rgURL[split.domain].lower()
+    if domain:
+        domain = domain.lower()
     
-    if not rgURL[split.domain] or not regDomain.search(rgURL[split.domain]) or len(rgURL[split.domain]) > 255:
-        raise reqfilter.Error("Invalid URL: %s" % urlparse.urlunsplit(rgURL))
+    # Only validate the host name - the domain (netloc) may include user info and a port
+    host = domain.rpartition('@')[2].split(':')[0]
+    if not host or not match_domain(host) or len(host) > 255:
+        raise reqfilter.Error("Invalid URL: %s" % urlunsplit((scheme, domain, path, query, fragment)))
 
     # Always end naked domains with a trailing slash as canonical
-    if rgURL[split.path] == '':
-        rgURL[split.path] = '/'
+    if path == '':
+        path = '/'
 
-    return urlparse.urlunsplit(rgURL)
+    return urlunsplit((scheme, domain, path, query, fragment))
 
 def domain_from_url(url):
-    return urlparse.urlsplit(url)[split.domain];
+    return urlsplit(url)[DOMAIN];
 